@@ -1,9 +1,15 @@
 import time
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
-import pandas as pd
 import subprocess
+import shutil
 import os
-import re
+import stat
+import sys
+import io
+import base64
+import csv
+import json
 
 # Load github token from environment variable
 load_dotenv()  
@@ -12,6 +18,16 @@ TOKEN = os.environ.get('GITHUB_TOKEN')
 if TOKEN is None:
     raise ValueError("Please set the GITHUB_TOKEN in the .env file.")
 
+# Environment for git commands that talk to GitHub: the token is passed as an HTTP header through git's
+# environment config instead of being baked into the clone URL, where it would be visible in the process list
+GIT_ENV = {
+    **os.environ,
+    'GIT_TERMINAL_PROMPT': '0',
+    'GIT_CONFIG_COUNT': '1',
+    'GIT_CONFIG_KEY_0': 'http.extraHeader',
+    'GIT_CONFIG_VALUE_0': 'Authorization: Basic ' + base64.b64encode(f'x-access-token:{TOKEN}'.encode()).decode(),
+}
+
 
 def get_commit_history_as_csv(repo_owner, repo_name):
   """
@@ -21,6 +37,11 @@ def get_commit_history_as_csv(repo_owner, repo_name):
   the 'git log' command, and then saves this information in a CSV file in the current working directory.
   It requires the GitHub username or organization (repo_owner) and the repository name (repo_name).
 
+  The clone is kept in the 'repos' folder. On later runs the repository only gets fetched and the commits 
+  that were not collected yet are appended to the existing CSV file. The branch tips that were already 
+  collected are stored in '{repo_name}_last_sha.json' next to the CSV file, together with the size of the CSV file
+  at that point, so rows of a failed run can be cut off again.
+
   :param str repo_owner: The GitHub username or organization of the repository. Example: 'microsoft'
   :param str repo_name: The name of the repository. Example: 'vscode'
   
@@ -32,24 +53,58 @@ def get_commit_history_as_csv(repo_owner, repo_name):
   """
   print(f"\n##### Collecting Data for {repo_name} Repository #####") # add text to make console output more readable
   # Check if repo has already been processed
-  if repo_already_existing(repo_owner, repo_name, repos):
+  if repo_already_existing(repo_owner, repo_name):
     print(f"Repo has already been processed -> Exit function")
     return
 
   start_time = time.time()  # Capture the start time
 
-  # Create a temporary folder that will store the repo
-  temp_dir = "temp_repo"
-  # Clone repo and collect commits
-  clone_repo(repo_owner, repo_name, temp_dir)
-  complete_commit_history = collect_commits(temp_dir)
+  # Folder that stores the repo between runs, unique per repo so parallel workers don't collide
+  repo_dir = os.path.join("repos", f"{repo_owner}_{repo_name}.git")
+  csv_path = f'./data/{repo_name}_commit_history.csv'
+  last_sha_path = f'./data/{repo_name}_last_sha.json'
+
+  # Only collect the new commits if the repo and its previous results are still around
+  collected_tips = []
+  if os.path.exists(repo_dir) and os.path.exists(csv_path) and os.path.exists(last_sha_path):
+    with open(last_sha_path) as last_sha_file:
+      last_sha = json.load(last_sha_file)
+    update_repo(repo_dir)
+    collected_tips = last_sha["tips"]
+    if get_missing_objects(repo_dir, collected_tips):
+      # Commits that were collected before got garbage collected (e.g. after a force-push),
+      # so it is no longer known which commits the CSV file contains
+      print("Previously collected commits are missing -> Collect the complete history again")
+      collected_tips = []
+    elif os.path.getsize(csv_path) < last_sha["csv_size"]:
+      # The CSV file got shorter since the last run (e.g. edited by hand), truncating would pad it with NUL bytes
+      print("CSV file is smaller than after the last run -> Collect the complete history again")
+      collected_tips = []
+    else:
+      # Drop rows an earlier incremental run appended before failing, they get collected again
+      os.truncate(csv_path, last_sha["csv_size"])
+  else:
+    # Start over from a fresh clone
+    if os.path.exists(repo_dir):
+      if sys.version_info >= (3, 12):
+        shutil.rmtree(repo_dir, onexc=remove_read_only)
+      else:
+        shutil.rmtree(repo_dir, onerror=remove_read_only)
+    clone_repo(repo_owner, repo_name, repo_dir)
+  current_tips = get_ref_tips(repo_dir)
 
-  # Convert commit history to data frame and export CSV file
-  commit_history_df = pd.DataFrame(complete_commit_history)
-  commit_history_df.to_csv(f'./data/{repo_name}_commit_history.csv', index=False)
+  # Write the commit history to the CSV file while it is being parsed
+  with open(csv_path, 'a' if collected_tips else 'w', newline='', buffering=1 << 20) as csv_file:
+    writer = csv.writer(csv_file, lineterminator='\n')  # LF like the committed CSV files
+    if not collected_tips:
+      writer.writerow(["hash", "author", "date", "file", "additions", "deletions"])
+    collect_commits(repo_dir, writer, collected_tips)
 
-  # Cleanup: Remove the cloned repo
-  subprocess.run(['rm', '-rf', temp_dir], check=True)
+  # Remember which commits are part of the CSV file now and where they end
+  # Write to a temporary file first, so an interrupted run can't leave a broken sidecar behind
+  with open(last_sha_path + '.tmp', 'w') as last_sha_file:
+    json.dump({"tips": current_tips, "csv_size": os.path.getsize(csv_path)}, last_sha_file)
+  os.replace(last_sha_path + '.tmp', last_sha_path)
 
   end_time = time.time()  # Capture the end time
   elapsed_time = end_time - start_time  # Calculate elapsed time
@@ -57,84 +112,187 @@ def get_commit_history_as_csv(repo_owner, repo_name):
 
 
 
-def repo_already_existing(owner, repo_name, repo_list):
-  for repo in repo_list:
-    if repo["owner"] == owner and repo["repo_name"] == repo_name:
-      return True
-    elif repo["repo_name"] == repo_name:
-      print("Project name already exists")
-      
+def remove_read_only(func, path, exc):
+  # git stores pack files read-only, which keeps Windows from deleting them
+  # onerror passes an exc_info tuple, onexc the exception itself
+  error = exc[1] if isinstance(exc, tuple) else exc
+  if not isinstance(error, PermissionError):
+    raise error
+  os.chmod(path, stat.S_IWRITE)
+  func(path)
+
+
+
+def repo_already_existing(owner, repo_name):
+  if (owner, repo_name) in REPO_SET:
+    return True
+  if NAME_TO_OWNER.get(repo_name) not in (None, owner):
+    print("Project name already exists")
+
   return False
 
 
 
-def clone_repo(repo_owner, repo_name, temp_dir):
+def clone_repo(repo_owner, repo_name, repo_dir):
   # Check if folder already exists
-  if os.path.exists(temp_dir):
-      raise FileExistsError(f"'{temp_dir}' already exists. Please provide a different path or remove the directory.")
+  if os.path.exists(repo_dir):
+      raise FileExistsError(f"'{repo_dir}' already exists. Please provide a different path or remove the directory.")
   else:
-    os.makedirs(temp_dir)
+    os.makedirs(repo_dir)
 
   # Clone the repository with all branches
-  repo_url = f"https://{TOKEN}@github.com/{repo_owner}/{repo_name}"
-  subprocess.run(['git', 'clone', '--mirror', repo_url, temp_dir], check=True)
+  repo_url = f"https://github.com/{repo_owner}/{repo_name}"
+  subprocess.run(
+    ['git', 'clone', '--mirror', repo_url, repo_dir],
+    check=True, env=GIT_ENV
+  )
   
   return
 
-def collect_commits(temp_dir):
+def update_repo(repo_dir):
+  # Fetch new commits of all branches and drop branches that were deleted on GitHub
+  subprocess.run(
+    ['git', '-C', repo_dir, '-c', 'transfer.unpackLimit=1', 'fetch', '--all', '--prune'],
+    check=True, env=GIT_ENV
+  )
+
+  return
+
+def get_ref_tips(repo_dir):
+  """
+  Returns the object ids all refs of a repository point to, i.e. everything 'git log --all' starts from.
+  """
+  ref_tips = subprocess.run(
+    ['git', '-C', repo_dir, 'for-each-ref', '--format=%(objectname)'],
+    check=True, capture_output=True, text=True
+  ).stdout.split()
+
+  return sorted(set(ref_tips))
+
+def get_missing_objects(repo_dir, object_ids):
+  """
+  Returns the object ids that don't exist in the repository (anymore).
+  """
+  batch_check = subprocess.run(
+    ['git', '-C', repo_dir, 'cat-file', '--batch-check'],
+    input=''.join(f'{object_id}\n' for object_id in object_ids), check=True, capture_output=True, text=True
+  ).stdout.splitlines()
+
+  return [line.split()[0] for line in batch_check if line.endswith(' missing')]
+
+def read_nul_records(stream, chunk_size=1 << 20):
+  """
+  Reads a text stream in large chunks and yields its NUL separated records one by one.
+  """
+  remainder = ''
+  while True:
+    chunk = stream.read(chunk_size)
+    if not chunk:
+      break
+    records = (remainder + chunk).split('\0')
+    # The last record might continue in the next chunk
+    remainder = records.pop()
+    yield from records
+  if remainder:
+    yield remainder
+
+def collect_commits(repo_dir, writer, collected_tips=()):
   """
   This function uses the git log command to collect the complete commit history of a specified repository.
-  The data then gets stored in a file centric way so in the end we get a df with changed files as rows (commits might 
+  The data then gets stored in a file centric way so in the end we get a CSV with changed files as rows (commits might 
   get split into multiple lines). This makes the data processing step easier.
+  Rows are passed to the given csv writer as soon as they are parsed and the number of rows is returned.
+  Commits reachable from collected_tips were collected in a previous run and get skipped.
+
+  git log runs with -z, so the output consists of NUL separated records: a commit starts with its tab separated 
+  metadata line followed by a newline and its first numstat entry, every further numstat entry is a record of its own
+  and an empty record separates two commits. For renamed files the numstat entry has an empty file name and is 
+  followed by two records holding the old and the new path.
   """
-  # Run git log with --numstat and split output into lines
+  # Run git log with --numstat and stream its output
+  # Commit messages are not used by the analysis, so only hash, author and date are requested
   # Increase rate limit to collect all files from bigger repos
-  log_output = subprocess.getoutput(
-      f"git -C {temp_dir} -c diff.renameLimit=10000 log --all --pretty=format:'%H | %an | %ad | %s' --numstat --date=format:'%Y-%m-%d %H:%M:%S'"
-      .replace('\n', '\\n') # replace newline character in commit messages
-  ).split('\n')
-
-  # Initialize an empty list for storing file changes
-  file_changes = []
+  # Already collected tips are excluded via stdin, as there can be too many for the command line
+  log_process = subprocess.Popen(
+      ['git', '-C', repo_dir, '-c', 'diff.renameLimit=10000', 'log', '--all', '--stdin', '-z',
+       '--pretty=format:%H%x09%an%x09%ad', '--numstat', '--date=format:%Y-%m-%d %H:%M:%S'],
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE
+  )
+  log_process.stdin.write(''.join(f'^{tip}\n' for tip in collected_tips).encode())
+  log_process.stdin.close()
+  # Decode in bulk and keep carriage returns in file names untouched
+  log_output = io.TextIOWrapper(log_process.stdout, encoding='utf-8', errors='replace', newline='')
 
-  # Regular expression pattern to match commit metadata, allowing for empty messages and missing authors
-  commit_pattern = re.compile(r'^([0-9a-fA-F]{40}) \| (.*?) \| (.+?) \| (.*)$')
-  # Regular expression pattern to match numstat data
-  numstat_pattern = re.compile(r'^(\d+|-)\s+(\d+|-)\s+(.+)$')
+  # Bind the hot-loop lookup to a local name and count the written file changes
+  writerow = writer.writerow
+  file_change_count = 0
 
   # Variables to hold current commit information
   current_hash = None
   current_author = None
   current_date = None
-  current_message = None
 
-  # Iterate over each line in log output
-  for line in log_output:
-    commit_match = commit_pattern.match(line)
-    numstat_match = numstat_pattern.match(line)
-    if commit_match:
+  # Parser state: whether the next record starts a commit and how many rename paths are still to come
+  expect_commit = True
+  rename_paths_left = 0
+
+  # Iterate over each record in log output
+  for record in read_nul_records(log_output):
+    if expect_commit:
       # When a new commit is found, update current commit information
-      current_hash, author, current_date, current_message = commit_match.groups()
+      commit_line, _, record = record.partition('\n')
+      commit_parts = commit_line.split('\t', 2)
+      if len(commit_parts) != 3:
+        # If the commit line does not match the expected format, it's unexpected
+        print(f"Unexpected format in line: {commit_line}")  # Debugging information
+        continue
+      current_hash, author, current_date = commit_parts
       # Set default author if missing
-      current_author = author if author else "Unknown Author"  
-    elif numstat_match and current_hash is not None:
-      # This line contains numstat data (number of lines added and removed, and file name)
-      additions, deletions, file_name = numstat_match.groups()
-      file_changes.append({
-        "hash": current_hash,
-        "author": current_author,
-        "date": current_date,
-        "message": current_message,
-        "file": file_name,
-        "additions": additions,
-        "deletions": deletions
-      })
-    elif line.strip():
-      # If the line is not empty and does not match the expected patterns, it's unexpected
-      print(f"Unexpected format in line: {line}")  # Debugging information
-
-  print(len(file_changes), "file changes were collected...")
-  return file_changes
+      current_author = author if author else "Unknown Author"
+      if not record:
+        # Commit without file changes (e.g. merges), the next record is another commit
+        continue
+      expect_commit = False
+    elif not record:
+      # An empty record ends the file changes of the current commit
+      expect_commit = True
+      continue
+
+    if rename_paths_left:
+      # Renamed files are stored with their new path, the old path gets skipped
+      rename_paths_left -= 1
+      if rename_paths_left:
+        continue
+      file_name = record
+    else:
+      # Numstat data is tab separated: number of lines added, lines removed and the file name
+      numstat_parts = record.split('\t', 2)
+      if len(numstat_parts) != 3:
+        print(f"Unexpected format in line: {record}")  # Debugging information
+        continue
+      additions, deletions, file_name = numstat_parts
+      if not file_name:
+        rename_paths_left = 2
+        continue
+
+    # Binary files have no line counts ('-'), write them as missing values
+    writerow((
+      current_hash,
+      current_author,
+      current_date,
+      file_name,
+      '' if additions == '-' else additions,
+      '' if deletions == '-' else deletions
+    ))
+    file_change_count += 1
+
+  # Wait for git to exit and make sure the history was read completely
+  log_output.close()
+  if log_process.wait() != 0:
+    raise subprocess.CalledProcessError(log_process.returncode, log_process.args)
+
+  print(file_change_count, "file changes were collected...")
+  return file_change_count
 
 #####################################
 # Collect commits from repositories #
@@ -158,31 +316,43 @@ repos = [
     {"owner": "langchain-ai", "repo_name": "langchain"},
 ]
 
-# tensorflow/tensorflow | 179k stars
-get_commit_history_as_csv('tensorflow','tensorflow') # 1'039'558 file changes | 374s
-# keras-team/keras | 59.8k stars
-get_commit_history_as_csv('keras-team','keras') # 91'281 file changes | 46s
-# pytorch/pytorch | 72.8k stars
-get_commit_history_as_csv('pytorch','pytorch') #  1'797'750 file changes | 581s
-# microsoft/vscode | 153k stars
-get_commit_history_as_csv('microsoft','vscode') #  651'090 file changes | 190s
-# microsoft/PowerToys | 98.9k stars
-get_commit_history_as_csv('microsoft','PowerToys') #  154'312 file changes | 57s
-# facebook/react | 216k stars
-get_commit_history_as_csv('facebook','react') #  266'857 file changes | 135s
-# facebook/react-native | 113k stars
-get_commit_history_as_csv('facebook','react-native') #  1'570'920 file changes | 451s
-# facebook/create-react-app | 101k stars
-get_commit_history_as_csv('facebook','create-react-app') #  46'197 file changes | 17s
-# home-assistant/core | 64.9k
-get_commit_history_as_csv('home-assistant','core') # 1'451'416 file changes | 253s
-# flutter/flutter | 159k
-get_commit_history_as_csv('flutter','flutter') # 918'396 file changes | 212s
-# microsoftdocs/azure-docs | 9.6k
-get_commit_history_as_csv('microsoftdocs','azure-docs') # 2'459'682 file changes | 2572s
-# automatic1111/stable-diffusion-webui | 114k
-get_commit_history_as_csv('automatic1111','stable-diffusion-webui') # 30'459 file changes | 21s
-# vercel/next.js | 116k
-get_commit_history_as_csv('vercel','next.js') # 405'327 file changes | 414s
-# langchain-ai/langchain | 71.2k
-get_commit_history_as_csv('langchain-ai','langchain') # 189790 file changes | 51s
\ No newline at end of file
+# Lookup structures for checking whether a repo was already processed
+REPO_SET = frozenset((repo["owner"], repo["repo_name"]) for repo in repos)
+NAME_TO_OWNER = {repo["repo_name"]: repo["owner"] for repo in repos}
+
+# Repositories to collect as (owner, repo_name) tuples
+TARGETS = [
+    # tensorflow/tensorflow | 179k stars
+    ('tensorflow', 'tensorflow'),  # 1'039'558 file changes | 374s
+    # keras-team/keras | 59.8k stars
+    ('keras-team', 'keras'),  # 91'281 file changes | 46s
+    # pytorch/pytorch | 72.8k stars
+    ('pytorch', 'pytorch'),  # 1'797'750 file changes | 581s
+    # microsoft/vscode | 153k stars
+    ('microsoft', 'vscode'),  # 651'090 file changes | 190s
+    # microsoft/PowerToys | 98.9k stars
+    ('microsoft', 'PowerToys'),  # 154'312 file changes | 57s
+    # facebook/react | 216k stars
+    ('facebook', 'react'),  # 266'857 file changes | 135s
+    # facebook/react-native | 113k stars
+    ('facebook', 'react-native'),  # 1'570'920 file changes | 451s
+    # facebook/create-react-app | 101k stars
+    ('facebook', 'create-react-app'),  # 46'197 file changes | 17s
+    # home-assistant/core | 64.9k
+    ('home-assistant', 'core'),  # 1'451'416 file changes | 253s
+    # flutter/flutter | 159k
+    ('flutter', 'flutter'),  # 918'396 file changes | 212s
+    # microsoftdocs/azure-docs | 9.6k
+    ('microsoftdocs', 'azure-docs'),  # 2'459'682 file changes | 2572s
+    # automatic1111/stable-diffusion-webui | 114k
+    ('automatic1111', 'stable-diffusion-webui'),  # 30'459 file changes | 21s
+    # vercel/next.js | 116k
+    ('vercel', 'next.js'),  # 405'327 file changes | 414s
+    # langchain-ai/langchain | 71.2k
+    ('langchain-ai', 'langchain'),  # 189790 file changes | 51s
+]
+
+if __name__ == "__main__":
+  # Repos are independent, so clone and parse several of them at the same time
+  with ProcessPoolExecutor(max_workers=min(4, os.cpu_count() or 1)) as executor:
+    list(executor.map(get_commit_history_as_csv, *zip(*TARGETS)))